@@ -7,36 +7,370 @@ Gridsearch function
 import itertools as it
 import json
 import pickle
+import warnings
 from copy import deepcopy
+from functools import partial
+from math import prod
 
 import numpy as np
 import pandas as pd
 import sklearn_json
 import xgboost as xgb
+from numba import njit
+from joblib import Parallel, delayed, dump
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis, QuadraticDiscriminantAnalysis
-from sklearn.ensemble import GradientBoostingClassifier, AdaBoostClassifier, RandomForestClassifier
+from sklearn.ensemble import GradientBoostingClassifier, AdaBoostClassifier, RandomForestClassifier, \
+    HistGradientBoostingClassifier
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
 from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import confusion_matrix
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.model_selection import HalvingGridSearchCV, PredefinedSplit, StratifiedKFold
+from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
 from sklearn.svm import SVC
 
+from scripts.model_search_space import model_search_space
 
-def param_list(candidate_params):
-    """Find all combinations of candidate parameters and return list of dicts"""
-    param_list = []
 
+class SharedIndexKNeighborsClassifier:
+    """
+    k-nearest neighbors classifier querying neighbors indices fitted once for all candidates, so that
+    the tree is not rebuilt for every n_neighbors and weights combination
+
+    :param indices: dict of NearestNeighbors fitted on training data, keyed by algorithm
+    :param n_neighbors: number of neighbors, at most the n_neighbors of the indices
+    :param weights: 'uniform' or 'distance'
+    :param algorithm: algorithm of the queried index
+    :param n_jobs: unused, the indices use their own number of jobs
+    """
+
+    def __init__(self, indices, n_neighbors=5, weights='uniform', algorithm='auto', n_jobs=None):
+        self.indices = indices
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.algorithm = algorithm
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        """Store training labels. X must be the data the indices were fitted on"""
+        self.y_ = np.asarray(y)
+        return self
+
+    def predict(self, X):
+        """Predict binary labels by (weighted) majority vote of the nearest neighbors"""
+        index = self.indices[self.algorithm]
+
+        if self.weights == 'distance':
+            dist, ind = index.kneighbors(X, n_neighbors=self.n_neighbors)
+            with np.errstate(divide='ignore'):
+                w = 1. / dist
+            # exact matches take all the weight, as in sklearn
+            inf_mask = np.isinf(w)
+            inf_rows = inf_mask.any(axis=1)
+            w[inf_rows] = inf_mask[inf_rows]
+        else:
+            ind = index.kneighbors(X, n_neighbors=self.n_neighbors, return_distance=False)
+            w = np.ones(ind.shape)
+
+        votes = self.y_[ind]
+        # ties go to the negative class, as in sklearn
+        return ((w * votes).sum(axis=1) > (w * (1 - votes)).sum(axis=1)).astype(np.int8)
+
+    def to_estimator(self, X):
+        """Return KNeighborsClassifier with the same parameters fitted on X and the stored labels"""
+        return KNeighborsClassifier(n_neighbors=self.n_neighbors, weights=self.weights, algorithm=self.algorithm,
+                                    n_jobs=self.n_jobs).fit(X, self.y_)
+
+
+def iter_params(candidate_params):
+    """Yield all combinations of candidate parameters as dicts"""
     if type(candidate_params) is dict:
-        keys, values = zip(*candidate_params.items())
-        param_list.extend([dict(zip(keys, v)) for v in it.product(*values)])
+        candidate_params = [candidate_params]
+
+    for cp in candidate_params:
+        keys, values = zip(*cp.items())
+        for v in it.product(*values):
+            yield dict(zip(keys, v))
+
+
+def _value_key(v):
+    """Hashable key of a parameter value, numpy scalars are keyed as python ones and 1, 1.0 and True differ"""
+    if isinstance(v, np.generic):
+        v = v.item()
+    return (type(v).__name__ if type(v) in (bool, int, float) else '', repr(v))
+
+
+def _params_key(p, exclude=()):
+    """Hashable key of a parameter dict, see _value_key"""
+    return tuple(sorted((k, *_value_key(v)) for k, v in p.items() if k not in exclude))
+
+
+def unique_params(params):
+    """Yield parameter dicts, skipping duplicate combinations"""
+    seen = set()
+    n_dropped = 0
+
+    for p in params:
+        key = _params_key(p)
+        if key in seen:
+            n_dropped += 1
+            continue
+        seen.add(key)
+        yield p
+
+    if n_dropped:
+        print(f'Dropped {n_dropped} duplicate parameter combinations')
+
+
+def n_params(candidate_params):
+    """Return number of combinations of candidate parameters without generating them"""
+    if type(candidate_params) is dict:
+        candidate_params = [candidate_params]
+
+    return sum(prod(len(v) for v in cp.values()) for cp in candidate_params)
+
+
+@njit(cache=True, error_model='numpy')
+def _metrics(y_true, y_pred):
+    """Return accuracy, sensitivity, specificity and mcc of binary labels and predictions in a single pass"""
+    tn = fp = fn = tp = 0
+    for i in range(y_true.size):
+        a = y_true[i]
+        b = y_pred[i]
+        tn += (1 - a) * (1 - b)
+        fp += (1 - a) * b
+        fn += a * (1 - b)
+        tp += a * b
+
+    acc = (tn + tp) / (tn + tp + fp + fn)
+    sens = tp / (tp + fn)
+    spec = tn / (tn + fp)
+    mcc = (tp * tn - fp * fn) / np.sqrt(float((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)))
+    return acc, sens, spec, mcc
+
+
+def _dmatrix(p, X, Y, ref=None):
+    """Build xgboost input of X and Y, QuantileDMatrix when the candidate p trains on GPU"""
+    if p.get('tree_method') == 'gpu_hist':
+        return xgb.QuantileDMatrix(X, Y, ref=ref)
+    return xgb.DMatrix(X, Y)
+
+
+def _boost_and_score(p, booster, X_train, Y_train, X_val, Y_val, num_boost_round):
+    """
+    Continue training of booster for up to num_boost_round rounds with early stopping on the validation set
+
+    :returns: validation mcc at the best iteration, the booster and whether early stopping was triggered
+    """
+    train_dmat = _dmatrix(p, X_train, Y_train)
+    val_dmat = _dmatrix(p, X_val, Y_val, ref=train_dmat)
+    start = 0 if booster is None else booster.num_boosted_rounds()
+    booster = xgb.train(p, train_dmat, num_boost_round=num_boost_round, xgb_model=booster,
+                        evals=[(val_dmat, 'validation')], early_stopping_rounds=15, verbose_eval=0)
+    stopped = booster.num_boosted_rounds() < start + num_boost_round
+
+    Y_hat_val = (booster.predict(val_dmat, iteration_range=(0, booster.best_iteration + 1)) > 0.5).view(np.uint8)
+    return _metrics(Y_val, Y_hat_val)[3], booster, stopped
+
+
+def _successive_halving_xgboost(params, X_train, Y_train, X_val, Y_val, factor=3, min_rounds=10, max_rounds=100,
+                                n_jobs=1):
+    """
+    Prune xgboost candidates by successive halving over boosting rounds. All candidates are trained
+    for min_rounds, the best 1/factor of them by validation mcc are continued for factor times more
+    rounds and so on, until max_rounds is reached or at most factor candidates remain. Candidates are
+    ranked by the best mcc seen so far, those that stopped early keep it and are not trained further
+
+    :param params: list of candidate parameters
+    :param X_train: training data
+    :param Y_train: training labels
+    :param X_val: validation data
+    :param Y_val: validation labels
+    :param factor: proportion of candidates kept in each rung is 1/factor
+    :param min_rounds: boosting rounds of the first rung
+    :param max_rounds: boosting rounds of the last rung
+    :param n_jobs: number of candidates trained in parallel processes
+    :returns: list of surviving candidate parameters
+    """
+    # (params, booster, best mcc, stopped early)
+    candidates = [(p, None, -1, False) for p in params]
+    done_rounds, rounds = 0, min_rounds
+
+    while len(candidates) > factor and done_rounds < max_rounds:
+        active = [i for i, (_, _, _, stopped) in enumerate(candidates) if not stopped]
+        scored = Parallel(n_jobs=n_jobs, prefer='processes')(
+            delayed(_boost_and_score)(candidates[i][0], candidates[i][1], X_train, Y_train, X_val, Y_val,
+                                      rounds - done_rounds)
+            for i in active)
+
+        for i, (mcc, booster, stopped) in zip(active, scored):
+            p, _, best_mcc, _ = candidates[i]
+            candidates[i] = (p, booster, max(best_mcc, np.nan_to_num(mcc, nan=-1)), stopped)
+
+        order = np.argsort([-best_mcc for _, _, best_mcc, _ in candidates], kind='stable')
+        top_k = int(np.ceil(len(candidates) / factor))
+        candidates = [candidates[i] for i in order[:top_k]]
+
+        done_rounds, rounds = rounds, min(rounds * factor, max_rounds)
+
+    return [p for p, _, _, _ in candidates]
+
+
+def _successive_halving_sklearn(params, X_train, Y_train, X_val, Y_val, estimator, factor=3, random_state=None,
+                                n_jobs=1):
+    """
+    Prune sklearn candidates by successive halving over training samples. Candidates are scored by
+    mcc on the provided validation set
+
+    :param params: list of candidate parameters
+    :param X_train: training data
+    :param Y_train: training labels
+    :param X_val: validation data
+    :param Y_val: validation labels
+    :param estimator: sklearn estimator class
+    :param factor: proportion of candidates kept in each iteration is 1/factor
+    :param random_state: random state for subsampling of training samples
+    :param n_jobs: number of candidates fitted in parallel
+    :returns: list of surviving candidate parameters
+    """
+    X = np.concatenate([X_train, X_val])
+    Y = np.concatenate([Y_train, Y_val])
+    split = PredefinedSplit(np.concatenate([np.full(len(Y_train), -1), np.zeros(len(Y_val))]))
+
+    search = HalvingGridSearchCV(estimator(), [{k: [v] for k, v in p.items()} for p in params], factor=factor,
+                                 cv=split, scoring='matthews_corrcoef', refit=False, random_state=random_state,
+                                 n_jobs=n_jobs)
+    search.fit(X, Y)
+
+    last_iter = search.cv_results_['iter'] == search.cv_results_['iter'].max()
+    return [p for p, last in zip(search.cv_results_['params'], last_iter) if last]
+
+
+def _fold_mcc(p, X_train, Y_train, train_idx, test_idx, model, model_dict, num_boost_round=2000):
+    """
+    Fit a candidate on one fold of the training set and return its mcc on the held out part
+
+    :param p: parameters dictionary of the candidate
+    :param X_train: training data
+    :param Y_train: training labels
+    :param train_idx: indices of the fold used for fitting
+    :param test_idx: indices of the held out part
+    :param model: lowercase model name
+    :param model_dict: mapping of model names to sklearn estimators
+    :param num_boost_round: maximum number of xgboost boosting rounds, training is stopped early on held out part
+    :returns: mcc on the held out part
+    """
+    if model == 'xgboost':
+        fold_train = _dmatrix(p, X_train[train_idx], Y_train[train_idx])
+        fold_test = _dmatrix(p, X_train[test_idx], Y_train[test_idx], ref=fold_train)
+        booster = xgb.train(p, fold_train, num_boost_round=num_boost_round, early_stopping_rounds=15,
+                            evals=[(fold_test, 'validation')], verbose_eval=0)
+        Y_hat = (booster.predict(fold_test, iteration_range=(0, booster.best_iteration + 1)) > 0.5).view(np.uint8)
     else:
-        for cp in candidate_params:
-            keys, values = zip(*cp.items())
-            param_list.extend([dict(zip(keys, v)) for v in it.product(*values)])
-    return param_list
+        fold_model = model_dict[model](**p)
+        fold_model.fit(X_train[train_idx], Y_train[train_idx])
+        Y_hat = fold_model.predict(X_train[test_idx])
+
+    return _metrics(Y_train[test_idx], Y_hat)[3]
 
 
-def gridsearch(X_train, Y_train, X_val, Y_val, model, params, modelpath=None,
-               resultspath=None, random_state=1618, n_jobs=1):
+def _fit_and_eval(p, X_train, Y_train, X_val, Y_val, model, model_dict, report_train=False, num_boost_round=2000,
+                  folds=None):
+    """
+    Fit a single candidate configuration and evaluate it on training and validation sets
+
+    :param p: parameters dictionary of the candidate
+    :param X_train: training data
+    :param Y_train: training labels
+    :param X_val: validation data
+    :param Y_val: validation labels
+    :param model: lowercase model name
+    :param model_dict: mapping of model names to sklearn estimators
+    :param report_train: evaluate the model on training set. Training metrics are nan otherwise
+    :param num_boost_round: maximum number of xgboost boosting rounds, training is stopped early on validation set
+    :param folds: list of (train, test) index arrays of the training set. Mean mcc over the folds is appended
+        to the results row
+    :returns: tuple of results row and the fitted model
+    """
+    # FIT
+    if model == 'xgboost':
+        # every task builds its own DMatrix, their lazily built caches are not safe to share between boosters
+        train_dmat = _dmatrix(p, X_train, Y_train)
+        val_dmat = _dmatrix(p, X_val, Y_val, ref=train_dmat)
+
+        # early stopping monitors the last evaluation set
+        evals = [(train_dmat, 'train'), (val_dmat, 'validation')] if report_train else [(val_dmat, 'validation')]
+        temp_model = xgb.train(p, train_dmat, num_boost_round=num_boost_round, early_stopping_rounds=15,
+                               evals=evals, verbose_eval=0)
+        # keep only the trees up to the best iteration, so the saved model predicts the same
+        temp_model = temp_model[:temp_model.best_iteration + 1]
+
+        # EVALUATE
+        # boolean mask viewed as 0/1 labels, no further arrays are allocated
+        if report_train:
+            Y_hat_train = (temp_model.predict(train_dmat) > 0.5).view(np.uint8)
+        Y_hat_val = (temp_model.predict(val_dmat) > 0.5).view(np.uint8)
+
+    else:
+        temp_model = model_dict[model](**p)
+        temp_model.fit(X_train, Y_train)
+
+        # EVALUATE
+        if report_train:
+            Y_hat_train = temp_model.predict(X_train)
+        Y_hat_val = temp_model.predict(X_val)
+
+    if report_train:
+        t_acc, t_sens, t_spec, t_mcc = _metrics(Y_train, Y_hat_train)
+    else:
+        t_acc = t_sens = t_spec = t_mcc = np.nan
+    v_acc, v_sens, v_spec, v_mcc = _metrics(Y_val, Y_hat_val)
+
+    row = [p, t_acc, t_sens, t_spec, t_mcc, v_acc, v_sens, v_spec, v_mcc]
+
+    if folds is not None:
+        row.append(np.mean([_fold_mcc(p, X_train, Y_train, train_idx, test_idx, model, model_dict, num_boost_round)
+                            for train_idx, test_idx in folds]))
+
+    return row, temp_model
+
+
+def _fit_and_eval_warm_start(group, X_train, Y_train, X_val, Y_val, model, model_dict, report_train=False):
+    """
+    Fit candidates differing only in n_estimators by growing a single warm started forest, and evaluate
+    a snapshot of it at every n_estimators
+
+    A group of a single candidate is fitted by plain _fit_and_eval, as warm start saves nothing there
+
+    :param group: list of candidate parameters sorted by ascending n_estimators
+    :param X_train: training data
+    :param Y_train: training labels
+    :param X_val: validation data
+    :param Y_val: validation labels
+    :param model: lowercase model name
+    :param model_dict: mapping of model names to sklearn estimators
+    :param report_train: evaluate the models on training set. Training metrics are nan otherwise
+    :returns: list of tuples of results row and the fitted model
+    """
+    if len(group) == 1:
+        return [_fit_and_eval(group[0], X_train, Y_train, X_val, Y_val, model, model_dict, report_train)]
+
+    forest = model_dict[model](warm_start=True)
+    # set_params returns the forest itself, so _fit_and_eval only fits the additional trees
+    warm_dict = {model: forest.set_params}
+
+    results_and_models = []
+    for i, p in enumerate(group):
+        row, fitted = _fit_and_eval(p, X_train, Y_train, X_val, Y_val, model, warm_dict, report_train)
+        # the last snapshot is not grown any further
+        snapshot = fitted if i == len(group) - 1 else deepcopy(fitted)
+        results_and_models.append((row, snapshot.set_params(warm_start=False)))
+
+    return results_and_models
+
+
+def gridsearch(X_train, Y_train, X_val, Y_val, model, params=None, modelpath=None,
+               resultspath=None, random_state=1618, outer_jobs=1, inner_jobs=1, successive_halving=False,
+               halving_factor=3, report_train=False, device='cpu',
+               serializer='joblib', num_boost_round=2000, cv=None, search_space=None):
     """
     Perform Gridsearch on candidate parameters and evaluate results on
     provided training and validation sets
@@ -46,9 +380,25 @@ def gridsearch(X_train, Y_train, X_val, Y_val, model, params, modelpath=None,
     :param X_val: validatoin dataframe
     :param Y_val: validation labels
     :param model: sklearn model
-    :param params: parameters dictionary
+    :param params: parameters dictionary. Taken from search_space if not provided
     :param outputpath: path where model and results should be saved as pickle
     :param random_state: random state for stochastic models
+    :param outer_jobs: number of candidate parameters fitted in parallel
+    :param inner_jobs: number of threads used by each model. Keep at 1 when outer_jobs > 1 to avoid oversubscription.
+        histgradientboosting ignores it, it uses OpenMP threads
+    :param successive_halving: prune candidates by successive halving before the full fits
+    :param halving_factor: proportion of candidates kept in each halving iteration is 1/halving_factor
+    :param report_train: evaluate every candidate on the training set as well. Training metrics are nan otherwise
+    :param device: 'cpu' or 'cuda[:<ordinal>]'. xgboost candidates are trained sequentially on the GPU for the latter
+    :param serializer: 'joblib' saves sklearn models to <modelpath>.joblib, 'onnx' to <modelpath>.onnx (requires
+        skl2onnx, checked before fitting), 'json' uses sklearn_json with pickle fallback. xgboost models are always
+        saved in their native format, as UBJSON if modelpath ends with .ubj
+    :param num_boost_round: maximum number of xgboost boosting rounds. Training of every candidate is stopped
+        after 15 rounds without improvement on validation set
+    :param cv: number of stratified folds of the training set, or 'auto' to size them by number of samples and
+        features. Candidates are then ranked by mean mcc over the folds instead of validation mcc
+    :param search_space: dict of candidate parameters per model, e.g. model_search_space_fast. Defaults to
+        model_search_space
     :returns: tuple of results list and the best model
     """
 
@@ -57,86 +407,146 @@ def gridsearch(X_train, Y_train, X_val, Y_val, model, params, modelpath=None,
 
     model = model.lower()
 
+    if serializer == 'onnx' and model != 'xgboost':
+        # fail before the grid is fitted rather than when saving the best model
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+
+    if params is None:
+        params = (search_space or model_search_space)[model]
+
     model_dict = {"svc": SVC,
                   "lda": LinearDiscriminantAnalysis, "qda": QuadraticDiscriminantAnalysis,
                   "logisticregression": LogisticRegression,
                   "randomforest": RandomForestClassifier,
                   "gradientboosting": GradientBoostingClassifier,
+                  "histgradientboosting": HistGradientBoostingClassifier,
                   "adaboost": AdaBoostClassifier,
                   "knn": KNeighborsClassifier}
 
-    stochastic = ["svc", "logisticregression", "gradientboosting", "adaboost",
+    stochastic = ["svc", "logisticregression", "gradientboosting", "histgradientboosting", "adaboost",
                   "randomforest", "xgboost"]
 
     isstochastic = (model in stochastic)
 
-    if model == 'xgboost':
-        train_dmat = xgb.DMatrix(X_train, Y_train)
-        val_dmat = xgb.DMatrix(X_val, Y_val)
-
-        # class imbalance
-        ci = np.sum(Y_train == 0) / np.sum(Y_train == 1)
-        params['scale_pos_weight'] = [ci, np.sqrt(ci), 1]
+    tree_based = ["randomforest", "gradientboosting", "adaboost", "xgboost"]
 
-    params = param_list(params)
+    # tree based models split on float32 features internally, the other solvers work in float64
+    dtype = np.float32 if model in tree_based else np.float64
+    # dtypes of a DataFrame, dtype of an array, read without converting the input
+    input_dtypes = getattr(X_train, 'dtypes', None)
+    if input_dtypes is None:
+        input_dtypes = [getattr(X_train, 'dtype', None)]
+    input_float64 = any(d == np.float64 for d in input_dtypes)
 
-    for p in params:
-        if isstochastic:
-            if model == 'xgboost':
-                p['seed'] = random_state
-            else:
-                p['random_state'] = random_state
+    X_train = np.ascontiguousarray(X_train, dtype=dtype)
+    X_val = np.ascontiguousarray(X_val, dtype=dtype)
 
-        if model in ['logisticregression', 'knn', 'randomforest']:
-            p['n_jobs'] = n_jobs
+    if dtype == np.float32 and input_float64 and (np.isnan(X_train).any() or np.isnan(X_val).any()):
+        warnings.warn('float64 features with missing values were cast to float32')
 
-        # FIT
-        if model == 'xgboost':
-            p['nthread'] = n_jobs
-            p['objective'] = 'binary:logistic'
-            temp_model = xgb.train(p, train_dmat, num_boost_round=100, early_stopping_rounds=15,
-                                   evals=[(train_dmat, 'train'), (val_dmat, 'validation')], verbose_eval=0)
+    Y_train = np.asarray(Y_train, dtype=np.int8)
+    Y_val = np.asarray(Y_val, dtype=np.int8)
 
-            # EVALUATE
-            Y_hat_train = (temp_model.predict(train_dmat) > 0.5) * 1
-            Y_hat_val = (temp_model.predict(val_dmat) > 0.5) * 1
+    use_gpu = model == 'xgboost' and device.startswith('cuda')
 
-        else:
-            temp_model = deepcopy(model_dict[model]())
-            temp_model.set_params(**p)
+    if use_gpu:
+        # one GPU, candidates are not fanned out
+        outer_jobs = 1
 
-            temp_model.fit(X_train, Y_train)
+    if model == 'xgboost':
+        # class imbalance
+        ci = np.sum(Y_train == 0) / np.sum(Y_train == 1)
+        params = {**params, 'scale_pos_weight': [float(ci), float(np.sqrt(ci)), 1.0]}
 
-            # EVALUATE
-            Y_hat_train = temp_model.predict(X_train)
-            Y_hat_val = temp_model.predict(X_val)
+    base_params = {}
+    if model == 'xgboost':
+        base_params['objective'] = 'binary:logistic'
+        base_params['nthread'] = inner_jobs
+        if isstochastic:
+            base_params['seed'] = random_state
+        if use_gpu:
+            base_params['tree_method'] = 'gpu_hist'
+            base_params['gpu_id'] = int(device.partition(':')[2] or 0)
+    else:
+        if isstochastic:
+            base_params['random_state'] = random_state
+        if model in ['logisticregression', 'knn', 'randomforest']:
+            base_params['n_jobs'] = inner_jobs
+
+    fit_dict = model_dict
+    if model == 'knn' and cv is None:
+        grids = [params] if type(params) is dict else params
+        if all(set(cp) <= {'n_neighbors', 'weights', 'algorithm'} for cp in grids):
+            max_k = max(max(cp.get('n_neighbors', [5])) for cp in grids)
+            algorithms = {a for cp in grids for a in cp.get('algorithm', ['auto'])}
+            indices = {a: NearestNeighbors(n_neighbors=max_k, algorithm=a, n_jobs=inner_jobs).fit(X_train)
+                       for a in algorithms}
+            fit_dict = {**model_dict, 'knn': partial(SharedIndexKNeighborsClassifier, indices)}
+
+    folds = None
+    if cv is not None:
+        n_folds = max(2, min(5, len(Y_train) // (X_train.shape[1] * 25))) if cv == 'auto' else cv
+        skf = StratifiedKFold(n_folds, shuffle=True, random_state=random_state)
+        folds = [(train_idx.astype(np.int32), test_idx.astype(np.int32))
+                 for train_idx, test_idx in skf.split(X_train, Y_train)]
+
+    n_candidates = n_params(params)
+    params = unique_params({**p, **base_params} for p in iter_params(params))
+
+    if successive_halving and n_candidates > halving_factor:
+        params = list(params)
+        if model == 'xgboost':
+            params = _successive_halving_xgboost(params, X_train, Y_train, X_val, Y_val, factor=halving_factor,
+                                                 max_rounds=num_boost_round, n_jobs=outer_jobs)
+        else:
+            params = _successive_halving_sklearn(params, X_train, Y_train, X_val, Y_val, model_dict[model],
+                                                 factor=halving_factor, random_state=random_state,
+                                                 n_jobs=outer_jobs)
+
+    # loky memory-maps arrays above 1 MB into a shared temp folder, workers do not receive copies of them.
+    # xgboost workers build their DMatrix from these arrays
+    if model == 'randomforest' and folds is None:
+        # candidates differing only in n_estimators grow the same forest
+        groups = {}
+        for p in params:
+            key = _params_key(p, exclude=('n_estimators',))
+            groups.setdefault(key, []).append(p)
+
+        batches = Parallel(n_jobs=outer_jobs, prefer='processes', return_as='generator')(
+            delayed(_fit_and_eval_warm_start)(sorted(group, key=lambda p: p.get('n_estimators', 100)),
+                                              X_train, Y_train, X_val, Y_val, model, fit_dict,
+                                              report_train)
+            for group in groups.values())
+        results_and_models = (rm for batch in batches for rm in batch)
+    else:
+        results_and_models = Parallel(n_jobs=outer_jobs, prefer='processes', return_as='generator')(
+            delayed(_fit_and_eval)(p, X_train, Y_train, X_val, Y_val, model, fit_dict, report_train,
+                                   num_boost_round, folds)
+            for p in params)
 
-        TN, FP, FN, TP = confusion_matrix(Y_train, Y_hat_train).ravel()
-        t_acc = (TN + TP) / (TN + TP + FP + FN)
-        t_sens = TP / (TP + FN)
-        t_spec = TN / (TN + FP)
-        t_mcc = (TP * TN - FP * FN) / np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+    for row, temp_model in results_and_models:
+        # validation mcc, or mean mcc over folds with cv
+        mcc = row[-1]
+        if mcc > best_mcc:
+            best_model = temp_model
+            best_mcc = mcc
 
-        TN, FP, FN, TP = confusion_matrix(Y_val, Y_hat_val).ravel()
-        v_acc = (TN + TP) / (TN + TP + FP + FN)
-        v_sens = TP / (TP + FN)
-        v_spec = TN / (TN + FP)
-        v_mcc = (TP * TN - FP * FN) / np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+        results.append(row)
 
-        if v_mcc > best_mcc:
-            best_model = deepcopy(temp_model)
-            best_mcc = v_mcc
+    if isinstance(best_model, SharedIndexKNeighborsClassifier):
+        best_model = best_model.to_estimator(X_train)
 
-        results.append([p, t_acc, t_sens, t_spec, t_mcc, v_acc, v_sens, v_spec, v_mcc])
+    columns = ['params', 'train_accuracy', 'train_sensitivity', 'train_specificity', 'train_mcc',
+               'validation_accuracy', 'validation_sensitivity', 'validation_specificity', 'validation_mcc']
+    if cv is not None:
+        columns.append('cv_mcc')
 
-    results = pd.DataFrame(results,
-                           columns=['params', 'train_accuracy', 'train_sensitivity', 'train_specificity', 'train_mcc',
-                                    'validation_accuracy', 'validation_sensitivity', 'validation_specificity',
-                                    'validation_mcc'])
+    results = pd.DataFrame(results, columns=columns)
 
-    results = results.sort_values('validation_mcc', ascending=False)
+    results = results.sort_values(columns[-1], ascending=False)
 
-    t_acc, t_sens, t_spec, t_mcc, v_acc, v_sens, v_spec, v_mcc = results.iloc[0, 1:]
+    t_acc, t_sens, t_spec, t_mcc, v_acc, v_sens, v_spec, v_mcc = results.iloc[0, 1:9]
 
     print(f'Best model params: {results.iloc[0, 0]}')
     print('Train:      Accuracy: {:3.3f}, Sensitivity: {:3.3f}, specificity: {:3.3f}, mcc: {:.3f}'.format(t_acc, t_sens,
@@ -145,11 +555,13 @@ def gridsearch(X_train, Y_train, X_val, Y_val, model, params, modelpath=None,
     print('Validation: Accuracy: {:3.3f}, Sensitivity: {:3.3f}, specificity: {:3.3f}, mcc: {:.3f}'.format(v_acc, v_sens,
                                                                                                           v_spec,
                                                                                                           v_mcc))
+    if cv is not None:
+        print('CV:         mcc: {:.3f}'.format(results.iloc[0, 9]))
 
     if modelpath is not None:
         if model == 'xgboost':
             best_model.save_model(modelpath)
-        else:
+        elif serializer == 'json':
             try:
                 sklearn_json.to_json(best_model, modelpath)
             except AttributeError:
@@ -158,6 +570,18 @@ def gridsearch(X_train, Y_train, X_val, Y_val, model, params, modelpath=None,
                 # save dummy json
                 with open(modelpath, 'w') as f:
                     json.dump({"info": "could not save model in json format. Used pickle instead"}, f)
+        elif serializer == 'onnx':
+            onx = convert_sklearn(best_model, initial_types=[('X', FloatTensorType([None, X_train.shape[1]]))])
+            with open(f'{modelpath}.onnx', 'wb') as f:
+                f.write(onx.SerializeToString())
+            # save dummy json
+            with open(modelpath, 'w') as f:
+                json.dump({"info": "model saved in onnx format", "path": f'{modelpath}.onnx'}, f)
+        else:
+            dump(best_model, f'{modelpath}.joblib', compress=3)
+            # save dummy json
+            with open(modelpath, 'w') as f:
+                json.dump({"info": "model saved with joblib", "path": f'{modelpath}.joblib'}, f)
 
     if resultspath:
         results.to_csv(resultspath, sep='\t')
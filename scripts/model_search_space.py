@@ -47,6 +47,14 @@ model_search_space = {
         'subsample': [0.3, 0.7, 1],
         'min_samples_split': [2, 3, 4]
     },
+    "histgradientboosting": {
+        'max_iter': [1000],
+        'learning_rate': [0.001, 0.01, 0.1, 1],
+        'max_leaf_nodes': [7, 15, 31],
+        'early_stopping': [True],
+        'validation_fraction': [0.1],
+        'n_iter_no_change': [15]
+    },
     "adaboost": {
         'n_estimators': [100, 500, 1000, 5000],
         'learning_rate': [0.001, 0.01, 0.1, 1]
@@ -65,3 +73,15 @@ model_search_space = {
         'colsample_bytree': [0.2, 0.4, 0.6, 0.8]
     }
 }
+
+# Reduced xgboost grid over the hyperparameters that matter most (max_depth, eta, subsample). lambda, gamma and
+# colsample_bytree are left at xgboost defaults and are better tuned in a subsequent Bayesian pass
+# (e.g. skopt.BayesSearchCV) around the best grid point than added to the grid
+model_search_space_fast = {
+    **model_search_space,
+    "xgboost": {
+        'max_depth': [3, 6, 8],
+        'eta': [0.03, 0.1, 0.3],
+        'subsample': [0.6, 0.8, 1.0]
+    }
+}